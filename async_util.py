@@ -2,7 +2,8 @@
 Asynchronous utilities.
 
 Emulates asyncio.loop.run_in_executor() but supports ProcessPoolExecutor by
-using functools.partial() instead of local functions.
+using functools.partial() instead of local functions. Also supports sharing a
+single in-flight call between concurrent callers.
 """
 
 from functools import partial
@@ -18,6 +19,38 @@ def run_async(func, *args):
 run_async._executor = None
 
 
+_inflight = {}
+_results = {}  # key -> (expiration time, result)
+
+def run_async_shared(key, func, *args, ttl=0):
+    """
+    Like run_async() but concurrent calls with the same key share one call to
+    func instead of each starting their own. Cancelling one of the callers does
+    not cancel the shared call. If ttl is given, a successful result is also
+    reused by calls with the same key for that many seconds.
+    """
+    loop = asyncio.get_running_loop()
+    entry = _results.get(key)
+    if entry is not None and entry[0] > loop.time():
+        future = loop.create_future()
+        future.set_result(entry[1])
+        return future
+    future = _inflight.get(key)
+    if future is None:
+        future = run_async(func, *args)
+        _inflight[key] = future
+        future.add_done_callback(partial(_shared_done, key, ttl))
+    return asyncio.shield(future)
+
+
+def _shared_done(key, ttl, future):
+    _inflight.pop(key, None)
+    if ttl > 0 and not future.cancelled() and future.exception() is None:
+        _results[key] = (future.get_loop().time() + ttl, future.result())
+    for k, (expires, _) in list(_results.items()):  # forget expired results
+        if expires <= future.get_loop().time(): del _results[k]
+
+
 def _wrap_future(src):
     future = asyncio.Future()
     future.add_done_callback(partial(_call_check_cancel, src))
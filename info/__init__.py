@@ -7,14 +7,17 @@ from datetime import timedelta
 from tornado.web import RequestHandler
 
 from printers import get_printer
-from async_util import run_async
+from async_util import run_async_shared
 
 
 class InfoHandler(RequestHandler):  # pylint: disable=abstract-method
     """Gets JSON describing the currently information about the printer."""
     async def get(self, name):  # pylint: disable=arguments-differ
         self.set_header('Content-Type', 'application/json')
-        self.write(await run_async(generate_info, name, self.settings['config']))
+        config = self.settings['config']
+        ttl = config.getfloat(name, 'cache-ttl', fallback=2.0)
+        self.write(await run_async_shared(
+            ('info', name), generate_info, name, config, ttl=ttl))
 
     def write_error(self, status_code, **kwargs):
         if 'message' not in kwargs:
@@ -3,7 +3,7 @@
 import os.path
 
 from tornado.web import StaticFileHandler, HTTPError
-from async_util import run_async
+from async_util import run_async_shared
 
 from printers import PrinterHandlerMixin, get_printer
 from model.gcode_parser import gcode_to_json, gcode_to_obj
@@ -39,7 +39,8 @@ class ModelHandler(StaticFileHandler, PrinterHandlerMixin):  # pylint: disable=a
         try: support = strtobool(self.get_argument('support', 'false'))
         except (ValueError, AttributeError): support = False
 
-        filename = await run_async(generate_model,
+        filename = await run_async_shared(
+            ('model', name_with_ext, infill, support), generate_model,
             name_with_ext, self.settings["config"], infill, support)
 
         # Return the file itself
@@ -1,14 +1,33 @@
 import os.path
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from copy import deepcopy
 from datetime import datetime, timedelta
-from functools import cache, cached_property
+from functools import cached_property, partial
+from time import monotonic
 
 import requests
+from requests.adapters import HTTPAdapter
 from tornado.web import HTTPError
 
-from ultimaker_api.ultimaker import PrintJobPauseSources, PrinterStatus, PrintJobState
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from ultimaker_api.ultimaker import Ultimaker as UltimakerAPI, \
+        PrintJobPauseSources, PrinterStatus, PrintJobState
+except ImportError:
+    UltimakerAPI = None  # Ultimaker printers are not supported
+
+# The known video_settings values, see Printer.video_settings
+VIDEO_TRANSFORMS = ('flipH', 'flipV', 'rotate90', 'rotate180', 'rotate270')
+VIDEO_ASPECT_RATIOS = ('16:9', '4:3', '3:2', '1:1')
 
 
-@cache
 def get_printer_classes_by_type():
     """
     Gets all subclasses of Printer in a dictionary with the key their TYPE.
@@ -28,17 +47,120 @@ class PrinterHandlerMixin:
         return get_printer(name, self.settings['config'])
 
 
+# Printer objects reused across requests: name -> [settings, printer, refreshed]
+_printers = {}
+
 def get_printer(name, config):
     # Get the configuration for the printer
     if name not in config: raise HTTPError(404)
     config = config[name]
     if 'type' not in config: raise HTTPError(404)
 
+    # Reuse the printer object from a previous request if the config matches
+    settings = tuple(config.items())
+    entry = _printers.get(name)
+    if entry is not None and entry[0] == settings:
+        printer = entry[1]
+        if monotonic() - entry[2] >= printer.cache_ttl:
+            printer.refresh()
+            entry[2] = monotonic()
+        return printer
+
     # Get the class to use for the printer
-    cls = get_printer_classes_by_type().get(config['type'], Printer)
+    cls = PRINTER_CLASSES.get(config['type'], Printer)
 
     # Create the printer object
-    return cls(config)
+    printer = cls(config)
+    _printers[name] = [settings, printer, monotonic()]
+    return printer
+
+
+def load_config(path):
+    """
+    Reads the config file, normalizing the printer sections and reporting any
+    problems with them at startup instead of on every request.
+    """
+    config = ConfigParser()
+    config.read(path)
+    for name in config.sections():
+        section = config[name]
+        if 'type' not in section: continue
+        section['type'] = section['type'].strip().lower()
+        if 'video_settings' in section:
+            settings = section['video_settings'].split()
+            for setting in settings:
+                if setting not in VIDEO_TRANSFORMS and setting not in VIDEO_ASPECT_RATIOS:
+                    print(f"Unknown video setting for {name}: {setting}", file=sys.stderr)
+            section['video_settings'] = ' '.join(settings)
+        try:
+            section.getfloat('cache-ttl', fallback=2.0)
+        except ValueError:
+            print(f"Invalid cache-ttl for {name}: {section['cache-ttl']}", file=sys.stderr)
+            section['cache-ttl'] = '2'
+    return config
+
+
+# Shared pool used to make several printer API calls at the same time
+_executor = ThreadPoolExecutor(8, thread_name_prefix='printer-api')
+
+def fetch_concurrently(*funcs):
+    """
+    Calls all of the functions at the same time in the shared thread pool.
+    Returns a list of their results with the exception raised in place of the
+    result for any that fail, see result_of().
+    """
+    def call(func):
+        try: return func()
+        except Exception as ex: return ex  # re-raised by result_of()
+    return list(_executor.map(call, funcs))
+
+
+def result_of(value):
+    """Returns a value from fetch_concurrently() or raises its exception."""
+    if isinstance(value, Exception): raise value
+    return value
+
+
+_sessions = {}
+
+def get_session(hostname, apikey):
+    """
+    Gets the shared HTTP session for the given OctoPrint server. Sessions are
+    kept for the life of the process so that connections are kept alive and
+    reused across requests.
+    """
+    key = (hostname, apikey)
+    session = _sessions.get(key)
+    if session is None:
+        session = requests.Session()
+        session.headers["X-Api-Key"] = apikey
+        session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        _sessions[key] = session
+    return session
+
+
+_ttl_cache = {}
+
+def ttl_cached(key, ttl, func):
+    """
+    Returns the result of func() while caching it under the given key for ttl
+    seconds so that requests close together (e.g. several viewers polling the
+    same printer) share one call to the printer. Exceptions are not cached.
+    """
+    now = monotonic()
+    entry = _ttl_cache.get(key)
+    if entry is not None and entry[0] > now: return entry[1]
+    value = func()
+    if len(_ttl_cache) >= 64:  # drop anything expired to keep the cache small
+        for k, (expires, _) in list(_ttl_cache.items()):
+            if expires <= now: _ttl_cache.pop(k, None)
+    _ttl_cache[key] = (now + ttl, value)
+    return value
+
+
+# Seconds that a file is known to still be up-to-date after being checked
+UP_TO_DATE_TTL = 1.0
+_up_to_date = {}  # (printer name, path) -> expiration time
 
 
 def file_mod_datetime(path):
@@ -52,6 +174,25 @@ class Printer:
     @property
     def name(self): return self.config.name
 
+    def refresh(self):
+        """
+        Forgets all information cached on this object so that it is obtained
+        from the printer again. Used when the object is reused by a later
+        request.
+        """
+        for cls in type(self).__mro__:
+            for value in vars(cls).values():
+                if isinstance(value, cached_property):
+                    self.__dict__.pop(value.attrname, None)
+
+    @cached_property
+    def cache_ttl(self):
+        """
+        Number of seconds that information obtained from the printer is reused
+        across requests, from the cache-ttl config setting (default 2).
+        """
+        return self.config.getfloat('cache-ttl', fallback=2.0)
+
     @property
     def status(self):
         """
@@ -80,13 +221,13 @@ class Printer:
         """
         return 'video' in self.config
 
-    @property
+    @cached_property
     def video_url(self): return self.config['video']
 
-    @property
+    @cached_property
     def video_type(self): return self.config.get('video_type', 'unknown')
 
-    @property
+    @cached_property
     def video_settings(self):
         """
         A list of settings for the video that can include any of:
@@ -107,7 +248,7 @@ class Printer:
         """
         return 'link' in self.config
 
-    @property
+    @cached_property
     def link(self): return self.config['link']
 
 
@@ -132,8 +273,14 @@ class Printer:
         exists and has a timestamp after the printer start most recent print
         job.
         """
-        return os.path.isfile(path) and (
-                file_mod_datetime(path) > self.job_started)
+        # Recent positive answers are reused to avoid repeated stat()s and job
+        # lookups while the same model is requested repeatedly
+        key = (self.name, path)
+        if _up_to_date.get(key, 0) > monotonic(): return True
+        if os.path.isfile(path) and file_mod_datetime(path) > self.job_started:
+            _up_to_date[key] = monotonic() + UP_TO_DATE_TTL
+            return True
+        return False
 
     @property
     def supports_job(self):
@@ -162,51 +309,54 @@ class Printer:
 class Ultimaker(Printer):
     TYPE = 'ultimaker'
 
+    if UltimakerAPI is not None:
+        # Printer states (other than printing) and print job states to statuses
+        PRINTER_STATUSES = {
+            PrinterStatus.IDLE: 'ready',
+            PrinterStatus.ERROR: 'error',
+            PrinterStatus.MAINTENANCE: 'error',
+            PrinterStatus.BOOTING: 'error',
+        }
+        JOB_STATUSES = {
+            PrintJobState.PRINTING: 'printing',
+            PrintJobState.RESUMING: 'printing',
+            PrintJobState.PRE_PRINT: 'printing',
+            PrintJobState.POST_PRINT: 'printing',
+            PrintJobState.PAUSED: 'paused',
+            PrintJobState.PAUSING: 'paused',
+            PrintJobState.NO_JOB: 'done',
+            PrintJobState.WAIT_CLEANUP: 'done',
+            PrintJobState.WAIT_USER_ACTION: 'done',
+        }
+
     def __init__(self, config):
-        from ultimaker_api.ultimaker import Ultimaker
-        if 'hostname' not in config: raise HTTPError(500)
+        if UltimakerAPI is None or 'hostname' not in config: raise HTTPError(500)
         super().__init__(config)
         self.hostname = config['hostname']
-        self.ultimaker = Ultimaker(self.hostname)
+        self.ultimaker = UltimakerAPI(self.hostname)
 
     @property
     def status(self):
         status = self.__status
-        if status == PrinterStatus.PRINTING:
-            status = self.__job["state"]
-            if status in (PrintJobState.PRINTING, PrintJobState.RESUMING,
-                          PrintJobState.PRE_PRINT, PrintJobState.POST_PRINT):
-                return 'printing'
-            elif status in (PrintJobState.PAUSED, PrintJobState.PAUSING):
-                return 'paused'
-            elif status in (PrintJobState.NO_JOB, PrintJobState.WAIT_CLEANUP,
-                            PrintJobState.WAIT_USER_ACTION):
-                return 'done'
-            else:
-                return 'unknown'
-        elif status in (PrinterStatus.ERROR, PrinterStatus.MAINTENANCE,
-                        PrinterStatus.BOOTING):
-            return 'error'
-        elif status == PrinterStatus.IDLE:
-            return 'ready'
-        else:
-            return 'unknown'
+        if status != PrinterStatus.PRINTING:
+            return self.PRINTER_STATUSES.get(status, 'unknown')
+        return self.JOB_STATUSES.get(self.__job["state"], 'unknown')
 
     @property
     def supports_video(self): return True
 
-    @property
+    @cached_property
     def video_url(self):
         return self.config.get('video',
                                f"http://{self.hostname}:8080/?action=stream")
 
-    @property
+    @cached_property
     def video_type(self): return self.config.get('video_type', "MJPEG")
 
     @property
     def supports_link(self): return True
 
-    @property
+    @cached_property
     def link(self):
         return self.config.get('link', f"http://{self.hostname}/print_jobs")
 
@@ -230,7 +380,19 @@ class Ultimaker(Printer):
     def job_started(self): return self.__job["datetime_started"]
 
     @cached_property
-    def __status(self): return self.ultimaker.printer.status
+    def __snapshot(self):
+        """
+        Fetches the printer status and the job concurrently since nearly every
+        use of the printer needs both.
+        """
+        return fetch_concurrently(
+            lambda: ttl_cached((self.hostname, 'status'), self.cache_ttl,
+                               lambda: self.ultimaker.printer.status),
+            lambda: ttl_cached((self.hostname, 'job'), self.cache_ttl,
+                               self.__fetch_job))
+
+    @cached_property
+    def __status(self): return result_of(self.__snapshot[0])
 
     @cached_property
     def __job(self):
@@ -249,6 +411,9 @@ class Ultimaker(Printer):
         A historical job also has:
           time_estimated  (not filled in for current jobs)
         """
+        return result_of(self.__snapshot[1])
+
+    def __fetch_job(self):
         try:
             return self.ultimaker.print_job.dict
         except (KeyError, ValueError):  # when there is no current job return most recent job
@@ -259,9 +424,32 @@ class Ultimaker(Printer):
             return job
 
 
+def iter_printed_files(files):
+    """
+    Iterates over all of the machinecode files with print history in the
+    OctoPrint file listing, including within folders.
+    """
+    queue = deque(files)
+    while queue:
+        file = queue.popleft()
+        if file["type"] == "folder":
+            queue.extend(file["children"])
+        elif file["type"] == "machinecode" and "prints" in file:
+            yield file
+
+
 class Octopi(Printer):
     TYPE = 'octopi'
 
+    # OctoPrint state flags in order of precedence along with their status
+    STATUS_FLAGS = (
+        ('paused', 'paused'), ('pausing', 'paused'),
+        ('printing', 'printing'), ('resuming', 'printing'),
+        ('finishing', 'printing'), ('cancelling', 'printing'),
+        ('closedOrError', 'error'), ('error', 'error'),
+        ('operational', 'ready'), ('ready', 'ready'),
+    )
+
     def __init__(self, config):
         if 'hostname' not in config or 'apikey' not in config:
             raise HTTPError(500)
@@ -275,17 +463,9 @@ class Octopi(Printer):
             status = self.__status
         except (KeyError, ValueError):
             return 'unknown'  # unable to connect to printer
-        if status.get("paused") or status.get("pausing"):
-            return 'paused'
-        elif status.get("printing") or status.get("resuming") or \
-                status.get("finishing") or status.get("cancelling"):
-            return 'printing'
-        elif status.get("closedOrError") or status.get("error"):
-            return 'error'
-        elif status.get("operational") or status.get("ready"):
-            return 'ready'
-        else:
-            return 'unknown'
+        for flag, value in self.STATUS_FLAGS:
+            if status.get(flag): return value
+        return 'unknown'
 
     @property
     def supports_video(self):
@@ -293,21 +473,21 @@ class Octopi(Printer):
         settings = self.__settings
         return "webcam" in settings and settings["webcam"]["webcamEnabled"] and settings["webcam"].get("streamUrl")
 
-    @property
+    @cached_property
     def video_url(self):
         if 'video' in self.config: return self.config['video']
         return self.__settings["webcam"]["streamUrl"]
 
-    @property
+    @cached_property
     def video_type(self):
         return self.config.get('video_type', 'MJPEG')  # defaults to MJPEG, but could be HLS...
 
-    @property
+    @cached_property
     def video_settings(self):
         if 'video_settings' in self.config: return self.config['video_settings'].split()
         webcam_settings = self.__settings["webcam"]
         settings = [setting
-                    for setting in ('flipH', 'flipV', 'rotate90', 'rotate180', 'rotate270')
+                    for setting in VIDEO_TRANSFORMS
                     if webcam_settings.get(setting, False)]
         if 'streamRatio' in webcam_settings: settings.append(webcam_settings['streamRatio'])
         return settings
@@ -315,7 +495,7 @@ class Octopi(Printer):
     @property
     def supports_link(self): return True
 
-    @property
+    @cached_property
     def link(self): return self.config.get('link', f"http://{self.hostname}/")
 
     @property
@@ -343,10 +523,23 @@ class Octopi(Printer):
         if job is None: return datetime.now()
         return datetime.now() - timedelta(seconds=job["progress"]["printTime"])
 
+    @cached_property
+    def __snapshot(self):
+        """
+        Fetches the printer, settings, and job information concurrently since
+        nearly every use of the printer needs all of them. Each value is either
+        the decoded JSON or the exception raised while fetching it.
+        """
+        cmds = ("printer", "settings", "job")
+        return dict(zip(cmds, fetch_concurrently(
+            *(partial(self.get, cmd) for cmd in cmds))))
+
+    def __fetched(self, cmd): return result_of(self.__snapshot[cmd])
+
     @cached_property
     def __status(self):
         try:
-            printer = self.get("printer")
+            printer = self.__fetched("printer")
         except ValueError as ex:
             if ex.args[0] == "Printer is not operational":
                 return {"error":True}
@@ -354,16 +547,17 @@ class Octopi(Printer):
         return printer["state"]["flags"]
 
     @cached_property
-    def __settings(self): return self.get("settings")
+    def __settings(self): return self.__fetched("settings")
 
     @cached_property
     def __job(self):
         if self.status in ("error", "unknown"): return None
-        try: job = self.get("job")
+        try: job = self.__fetched("job")
         except ValueError: return None
         if job["state"] == "Operational":  # TODO
             file = self.__find_most_recent_file(self.__files["files"])
             if file is None: return None
+            job = deepcopy(job)  # the response is cached, don't modify it
             #job["job"]["lastPrintTime"] = ...
             job["job"]["file"]["name"] = file["name"]
             job["job"]["file"]["origin"] = file["origin"]
@@ -382,18 +576,10 @@ class Octopi(Printer):
             job["state"] == "Completed"
         return job
 
-    def __find_most_recent_file(self, files):
-        most_recent_file = None
-        most_recent_date = 0
-        for file in files:
-            if file["type"] == "folder":
-                file = self.__find_most_recent_file(file["children"])
-            if file is None or file["type"] != "machinecode" or "prints" not in file:
-                continue
-            if most_recent_date < file["prints"]["last"]["date"]:
-                most_recent_file = file
-                most_recent_date = file["prints"]["last"]["date"]
-        return most_recent_file
+    @staticmethod
+    def __find_most_recent_file(files):
+        return max(iter_printed_files(files), default=None,
+                   key=lambda file: file["prints"]["last"]["date"])
 
     @cached_property
     def __job_file(self):
@@ -403,16 +589,26 @@ class Octopi(Printer):
         return self.get(f"files/{file['origin']}/{file['path']}") # full info
 
     @cached_property
-    def __files(self): return self.get(f"files?recursive=true")
+    def __files(self):
+        # only local files have print history, skip listing the SD card
+        return self.get("files/local?recursive=true")
+
+    @cached_property
+    def session(self): return get_session(self.hostname, self.apikey)
 
     def fetch(self, url, json=True):
-        request = requests.get(
-            url, headers={"X-Api-Key":self.apikey})
         if json:
-            data = request.json()
-            if "error" in data: raise ValueError(data["error"])
-            return data
-        return request
+            return ttl_cached(url, self.cache_ttl, lambda: self.__fetch_json(url))
+        return self.session.get(url)
+
+    def __fetch_json(self, url):
+        data = json_loads(self.session.get(url).content)
+        if "error" in data: raise ValueError(data["error"])
+        return data
 
     def get(self, cmd):
         return self.fetch(f'http://{self.hostname}/api/{cmd}')
+
+
+# All known printer classes by their TYPE, must be after all classes
+PRINTER_CLASSES = get_printer_classes_by_type()
@@ -5,11 +5,11 @@
 
 import os
 import asyncio
-from configparser import ConfigParser
 
 from tornado.web import Application, StaticFileHandler, RequestHandler, RedirectHandler
 from tornado.options import define, options, parse_command_line
 
+from printers import load_config
 from info import InfoHandler
 from model import ModelHandler
 from video import VideoHandler, VideoStaticFileHandler, terminate_video_streams
@@ -25,9 +25,8 @@ class TemplateHandler(RequestHandler): # pylint: disable=abstract-method
 
 async def main():
     # Get the config information
-    config = ConfigParser()
     directory = os.path.dirname(os.path.abspath(__file__))
-    config.read(os.path.join(directory, 'config.ini'))
+    config = load_config(os.path.join(directory, 'config.ini'))
     
     app = Application([
         (r"/info/(.*)\.json", InfoHandler),
@@ -42,11 +41,11 @@ async def main():
     # Start
     print(f"Listening on port {options.port}...")
     app.listen(options.port)
-    await asyncio.Event().wait()
-
-if __name__ == "__main__":
-    parse_command_line()
     try:
-        asyncio.run(main())
+        await asyncio.Event().wait()
     finally:
         terminate_video_streams()
+
+if __name__ == "__main__":
+    parse_command_line()
+    asyncio.run(main())
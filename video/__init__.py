@@ -18,14 +18,13 @@ Raspberry Pi.
 import os
 import errno
 import asyncio
-import subprocess
 import shutil
-from time import time
+from functools import partial
 
 from tornado.web import StaticFileHandler, HTTPError
-from tornado.ioloop import PeriodicCallback
 
-from printers import PrinterHandlerMixin
+from printers import get_printer
+from async_util import run_async
 
 try:
     import aiofiles.os
@@ -33,16 +32,40 @@ try:
 except ImportError:
     have_aiofiles = False
 
+try:
+    from asyncinotify import Inotify, Mask
+    have_inotify = True
+except ImportError:
+    have_inotify = False
+
 DEFAULT_CONF = {
     'tmp': '/dev/shm/vid-stream',
     'keep-alive': 60,
 }
 
+# seconds to wait for ffmpeg to produce the first playlist
+START_TIMEOUT = 30
+
+# name -> [process (or future while starting), stop timer]
 streams = {}
-stream_terminator = None
 
 
-async def start_streaming(printer, path):
+def run_in_thread(func, *args, **kwargs):
+    """Runs a blocking function in the default thread pool of the event loop."""
+    return asyncio.get_running_loop().run_in_executor(
+        None, partial(func, *args, **kwargs))
+
+
+def get_video_url(name, config):
+    """
+    Gets the URL of the video for the printer or None if the printer does not
+    support video. This blocks, should be used with an executor.
+    """
+    printer = get_printer(name, config)
+    return printer.video_url if printer.supports_video else None
+
+
+async def start_streaming(name, url, path):
     """
     Starts the streaming service for the given printer. This function is
     asynchronous and must be used with await since it doesn't complete until
@@ -51,53 +74,136 @@ async def start_streaming(printer, path):
 
     # Ensure path exists
     if have_aiofiles: await aiofiles.os.makedirs(path, exist_ok=True)
-    else: os.makedirs(path, exist_ok=True)
+    else: await run_in_thread(os.makedirs, path, exist_ok=True)
 
     # Get the video's files
-    m3u8 = printer.name + '.m3u8'
+    m3u8 = name + '.m3u8'
     m3u8_full = os.path.join(path, m3u8)
 
     # Remove evidence of previous streaming
     try:
         if have_aiofiles: await aiofiles.os.remove(m3u8_full)
-        else: os.remove(m3u8_full)
+        else: await run_in_thread(os.remove, m3u8_full)
     except OSError as ex:
         if ex.errno != errno.ENOENT: raise
 
-    print('Starting stream for '+printer.name+'...')
+    print('Starting stream for '+name+'...')
     # TODO: base conversions needed off of video type
     # e.g. could be HLS already and RTSP may not need transcoding
     # FFMPEG: https://www.ffmpeg.org/ffmpeg-formats.html#hls-2
     ffmpeg = shutil.which('ffmpeg') or 'ffmpeg'
-    proc = subprocess.Popen((
-        ffmpeg, '-hide_banner', '-nostats', '-loglevel', 'error',
-        '-i', printer.video_url,
-        '-c:v', 'h264', '-profile:v', 'high', '-level', '4.1',
-        '-an', '-flags', '+cgop', '-g', '30', '-pix_fmt', 'yuv420p',
-        '-hls_time', '2', '-hls_list_size', '3',
-        '-hls_flags', 'delete_segments', '-f', 'hls', m3u8
-    ), cwd=path)
-
-    # Wait for the streaming to begin
-    while not os.path.isfile(m3u8_full):  # TODO: could use aiofiles
-        await asyncio.sleep(0.001)
+    inotify = watch_directory(path)  # watch before ffmpeg can make the file
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            ffmpeg, '-hide_banner', '-nostats', '-loglevel', 'error',
+            '-i', url,
+            '-c:v', 'h264', '-profile:v', 'high', '-level', '4.1',
+            '-an', '-flags', '+cgop', '-g', '30', '-pix_fmt', 'yuv420p',
+            '-hls_time', '2', '-hls_list_size', '3',
+            '-hls_flags', 'delete_segments', '-f', 'hls', m3u8,
+            cwd=path)
+
+        # Wait for the streaming to begin
+        try:
+            await asyncio.wait_for(
+                wait_for_file(inotify, m3u8_full, proc), START_TIMEOUT)
+        except BaseException as ex:
+            terminate(proc)
+            if isinstance(ex, asyncio.TimeoutError): raise HTTPError(504) from ex
+            raise
+    finally:
+        if inotify is not None: inotify.close()
 
     # Return the process so it can be terminated later
     return proc
 
 
-def terminate_video_streams(stale_secs=None):
-    """Terminate all (stale) streams."""
-    stale = None if stale_secs is None else time() - stale_secs
-    for name, info in streams.copy().items():
-        if stale is None or info[1] < stale:
-            print("Stopping stream for "+name+"...")
-            if info[0] is not None:
-                info[0].terminate()
-            del streams[name]
+def watch_directory(path):
+    """
+    Starts watching the directory for new files if inotify is available,
+    returning the Inotify object (or None if not available).
+    """
+    if not have_inotify: return None
+    try:
+        inotify = Inotify()
+    except OSError:
+        return None
+    try:
+        # ffmpeg writes the playlist to a temporary file then renames it
+        inotify.add_watch(path, Mask.CREATE | Mask.MOVED_TO)
+    except OSError:
+        inotify.close()
+        return None
+    return inotify
 
 
-class VideoStaticFileHandler(StaticFileHandler, PrinterHandlerMixin):  # pylint: disable=abstract-method
+async def wait_for_file(inotify, path, proc):
+    """
+    Waits for the file at path to exist. Uses the inotify object from
+    watch_directory() if possible, otherwise polls with an increasing delay.
+    Raises an HTTPError if the process exits before the file exists.
+    """
+    isfile = aiofiles.os.path.isfile if have_aiofiles else partial(run_in_thread, os.path.isfile)
+    if inotify is not None:
+        if await isfile(path): return
+        name = os.path.basename(path)
+        async def created():
+            async for event in inotify:
+                if event.name is not None and str(event.name) == name: return
+        created_task = asyncio.ensure_future(created())
+        exited_task = asyncio.ensure_future(proc.wait())
+        try:
+            done, _ = await asyncio.wait((created_task, exited_task),
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            created_task.cancel()
+            exited_task.cancel()
+        if created_task not in done: raise HTTPError(502)
+        created_task.result()  # raise any error from inotify
+        return
+    delay = 0.01
+    while not await isfile(path):
+        if proc.returncode is not None: raise HTTPError(502)
+        await asyncio.sleep(delay)
+        delay = min(delay*2, 0.25)
+
+
+def stop_stream(name):
+    """Terminates the stream and forgets about it."""
+    proc, timer = streams.pop(name)
+    print("Stopping stream for "+name+"...")
+    if timer is not None: timer.cancel()
+    if not isinstance(proc, asyncio.Future): terminate(proc)
+
+
+def terminate(proc):
+    """
+    Terminates the ffmpeg process if it is still running. The event loop's
+    child watcher reaps it once it exits.
+    """
+    try:
+        proc.terminate()
+    except ProcessLookupError:
+        pass  # already exited
+
+
+def stop_stale_stream(name):
+    """
+    Terminates the stream once it has gone unused, the timer calling this is
+    restarted every time the stream is accessed.
+    """
+    info = streams.get(name)
+    if info is None or isinstance(info[0], asyncio.Future): return
+    stop_stream(name)
+
+
+def terminate_video_streams():
+    """Terminate all streams."""
+    for name in list(streams):
+        stop_stream(name)
+
+
+class VideoStaticFileHandler(StaticFileHandler):  # pylint: disable=abstract-method
     def initialize(self, **kwargs):
         tmp = self.get_config('tmp')
         if not os.path.isdir(tmp):
@@ -108,32 +214,47 @@ class VideoStaticFileHandler(StaticFileHandler, PrinterHandlerMixin):  # pylint:
         val = self.settings['config'].get('VIDEO', name, fallback=None)
         return DEFAULT_CONF[name] if val is None else val
 
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        # Segments are small and on the ram-disk so send each with a single
+        # write instead of the default 64 KiB chunks that are each flushed
+        with open(abspath, "rb") as file:
+            if start is not None: file.seek(start)
+            return file.read() if end is None else file.read(end - (start or 0))
+
 
 class VideoHandler(VideoStaticFileHandler):  # pylint: disable=abstract-method
     """Handles *.m3u8 links which start the streaming service."""
 
     async def get(self, name, include_body=True):  # pylint: disable=arguments-differ
-        # Make sure the terminator has started
-        global stream_terminator
-        if stream_terminator is None:
-            keep_alive = int(self.get_config('keep-alive'))
-            stream_terminator = PeriodicCallback(
-                lambda: terminate_video_streams(keep_alive*2), keep_alive*1000)
-            stream_terminator.start()
-        
         if name not in streams:
-            # Streaming not currently running, start it
-            printer = self.get_printer(name)
-            if not printer.supports_video: raise HTTPError(400)
-            streams[name] = [None, time()]
-            proc = await start_streaming(printer, self.root)
-            streams[name] = [proc, time()]
-        else:
-            while streams[name] is None:
-                # Stream is being started right now, wait a little bit
-                await asyncio.sleep(0.001)
-            
-            # Stream is started, update last time accessed
-            streams[name][1] = time()
+            # Streaming not currently running, start it, other requests for
+            # the stream wait on the future until it has started
+            starting = asyncio.get_running_loop().create_future()
+            streams[name] = [starting, None]
+            try:
+                url = await run_async(get_video_url, name, self.settings['config'])
+                if url is None: raise HTTPError(400)
+                proc = await start_streaming(name, url, self.root)
+            except BaseException as ex:
+                streams.pop(name, None)
+                if isinstance(ex, asyncio.CancelledError): starting.cancel()
+                else:
+                    starting.set_exception(ex)
+                    starting.exception()  # mark as retrieved if no one is waiting
+                raise
+            starting.set_result(proc)
+            streams[name] = [proc, None]
+        elif isinstance(streams[name][0], asyncio.Future):
+            # Stream is being started right now, wait for it
+            await asyncio.shield(streams[name][0])
+
+        # Stream is started, restart the timer for when it will stop
+        if name in streams:
+            info = streams[name]
+            if info[1] is not None: info[1].cancel()
+            stale_secs = int(self.get_config('keep-alive'))*2
+            info[1] = asyncio.get_running_loop().call_later(
+                stale_secs, stop_stale_stream, name)
 
         await super().get(name+'.m3u8', include_body)